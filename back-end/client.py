@@ -1,38 +1,111 @@
-from typing import Optional
+from typing import Optional, Dict, List, Tuple, TYPE_CHECKING
 from contextlib import AsyncExitStack
+import asyncio
+import hashlib
 import traceback
 from logs import logger
-from mcp import ClientSession, StdioServerParameters
-from mcp.client.stdio import stdio_client
 from datetime import datetime
 import json
 import os
+import shutil
+import sys
 from pathlib import Path
-from fastmcp import Client as FastMCPClient
+from usage import UsageTracker, QueryUsage
+from profiling import profile
+
+# mcp, fastmcp and anthropic are imported where they are first used, so only
+# the transport actually selected (and the LLM SDK, off the startup path) is loaded
+if TYPE_CHECKING:
+    from anthropic import Anthropic
+    from anthropic.types import Message
+    from mcp import ClientSession
+    from fastmcp import Client as FastMCPClient
+
+
+def resolve_server_command(
+    server_script_path: str,
+    server_cwd: str,
+    server_python: Optional[str] = None,
+) -> Tuple[str, List[str]]:
+    """
+    Resolve once how to launch the MCP server.
+    Running the server project's own interpreter directly skips the environment
+    sync `uv run` performs on every launch. `uv run` is only the fallback for a
+    project with no .venv yet: there the environment has to be created, so it
+    cannot skip syncing, but `--frozen` installs straight from uv.lock without
+    re-resolving it. Once .venv exists, later starts use its interpreter directly.
+    """
+    if server_python:
+        return server_python, [server_script_path]
+
+    venv = Path(server_cwd) / ".venv"
+    python = venv / ("Scripts/python.exe" if sys.platform == "win32" else "bin/python")
+    if python.exists():
+        return python.as_posix(), [server_script_path]
 
-from anthropic import Anthropic
-from anthropic.types import Message
+    uv = shutil.which("uv") or "uv"
+    return uv, ["run", "--frozen", server_script_path]
 
 
 class MCPClient: 
     """
     MCP Cliente class, comunicates with llm and mcp-servers
     """
-    def __init__(self):
+    def __init__(
+        self,
+        usage: Optional[UsageTracker] = None,
+        model: str = "claude-sonnet-4-20250514",
+        fallback_model: Optional[str] = None,
+        max_tokens: int = 1000,
+    ):
         # Initialize session and client objects
-        self.session: Optional[ClientSession] = None          
-        self.remote_client: Optional[FastMCPClient] = None   
+        self.session: Optional["ClientSession"] = None
+        self.remote_client: Optional["FastMCPClient"] = None
         self.exit_stack = AsyncExitStack()
-        self.llm = Anthropic()
+        self._llm: Optional["Anthropic"] = None
         self.tools = []
-        self.messages = []
+        self.tools_etag: Optional[str] = None
+        # Message history per session id
+        self.conversations: Dict[str, list] = {}
         self.logger = logger
-        
+        self.usage = usage or UsageTracker()
+        self.model = model
+        self.fallback_model = fallback_model
+        self.max_tokens = max_tokens
+
+    @property
+    def llm(self) -> "Anthropic":
+        """
+        Anthropic client, created (and the SDK imported) on first use
+        """
+        if self._llm is None:
+            from anthropic import Anthropic
+
+            self._llm = Anthropic()
+        return self._llm
+
+    async def warm_llm(self):
+        """
+        Import the LLM SDK and build its client in a worker thread,
+        so it overlaps with the MCP connection instead of delaying it
+        """
+        with profile("llm_sdk"):
+            await asyncio.to_thread(lambda: self.llm)
+
     # Connect to a local MCP server via stdio 
-    async def connect_to_server(self, server_script_path: str, server_cwd: Optional[str] = None):
+    async def connect_to_server(
+        self,
+        server_script_path: str,
+        server_cwd: Optional[str] = None,
+        server_command: Optional[Tuple[str, List[str]]] = None,
+    ):
         """
         Connects to an MCP server over stdio (local process).
+        `server_command` is a pre-resolved (command, args) pair, see resolve_server_command.
         """
+        with profile("import_mcp"):
+            from mcp import ClientSession, StdioServerParameters
+            from mcp.client.stdio import stdio_client
 
         # Validate server python script
         is_python = server_script_path.endswith(".py")
@@ -41,34 +114,39 @@ class MCPClient:
 
         cwd = server_cwd or Path(server_script_path).parent.as_posix()
 
-        self.logger.info(f"Starting MCP server with uv: uv run {server_script_path} (cwd={cwd})")
+        command, args = server_command or resolve_server_command(server_script_path, cwd)
+
+        self.logger.info(f"Starting MCP server: {command} {' '.join(args)} (cwd={cwd})")
 
         server_params = StdioServerParameters(
-            command="uv", 
-            args=["run", server_script_path],
+            command=command,
+            args=args,
             env=os.environ.copy(),
             cwd=cwd,
         )
 
-        stdio_transport = await self.exit_stack.enter_async_context(
-            stdio_client(server_params)
-        )
-        self.stdio, self.write = stdio_transport
-        self.session = await self.exit_stack.enter_async_context(
-            ClientSession(self.stdio, self.write)
-        )
+        with profile("mcp_spawn"):
+            stdio_transport = await self.exit_stack.enter_async_context(
+                stdio_client(server_params)
+            )
+            self.stdio, self.write = stdio_transport
+            self.session = await self.exit_stack.enter_async_context(
+                ClientSession(self.stdio, self.write)
+            )
 
-        # Start session with server    
-        await self.session.initialize()
-        mcp_tools = await self.get_mcp_tools()
-        self.tools = [
+        # Start session with server (list_tools needs an initialized session)
+        with profile("mcp_initialize"):
+            await self.session.initialize()
+        with profile("mcp_list_tools"):
+            mcp_tools = await self.get_mcp_tools()
+        self.set_tools([
             {
                 "name": tool.name,
                 "description": tool.description,
                 "input_schema": tool.inputSchema,
             }
             for tool in mcp_tools
-        ]
+        ])
 
         return True
 
@@ -79,23 +157,36 @@ class MCPClient:
         """
         self.logger.info(f"Connecting to remote MCP server: {base_url}")
 
+        with profile("import_fastmcp"):
+            from fastmcp import Client as FastMCPClient
+
         # Open FastMCP HTTP client in the same exit_stack for unified cleanup
-        self.remote_client = await self.exit_stack.enter_async_context(FastMCPClient(base_url))
-               
+        with profile("mcp_connect_remote"):
+            self.remote_client = await self.exit_stack.enter_async_context(FastMCPClient(base_url))
+
         # Fetch and cache tools (same shape used by Anthropic tools param)
-        mcp_tools = await self.get_mcp_tools()
-        self.tools = [
+        with profile("mcp_list_tools"):
+            mcp_tools = await self.get_mcp_tools()
+        self.set_tools([
             {
                 "name": t.name,
                 "description": getattr(t, "description", "") or "",
                 "input_schema": getattr(t, "inputSchema", None) or getattr(t, "input_schema", None),
             }
             for t in mcp_tools
-        ]
+        ])
 
         self.logger.info("Connected to remote MCP server successfully.")
         return True
 
+    def set_tools(self, tools: list):
+        """
+        Cache the tool list (in the shape the Anthropic tools param uses) and its ETag
+        """
+        self.tools = tools
+        digest = hashlib.sha256(json.dumps(tools, sort_keys=True, default=str).encode()).hexdigest()
+        self.tools_etag = f'"{digest[:32]}"'
+
     async def call_tool(self, name: str, args: dict):
         """
         Helper the /tool endpoint expects
@@ -141,28 +232,100 @@ class MCPClient:
             await self.exit_stack.aclose()
         except Exception as e:
             self.logger.error(f"Error during cleanup: {str(e)}")
+        finally:
+            # Leave the client reusable for another connection attempt
+            self.exit_stack = AsyncExitStack()
+            self.session = None
+            self.remote_client = None
 
-    async def call_llm(self) -> Message:
+    async def estimate_input_tokens(self, model: str, messages: list, query_usage: QueryUsage) -> int:
         """
-        Call the LLM with the given query
+        Input tokens the next call to `model` will send. Falls back to the previous
+        call's input size (a lower bound) if token counting is unavailable.
         """
         try:
-            return self.llm.messages.create(
-                model="claude-sonnet-4-20250514",
-                max_tokens=1000,
-                messages=self.messages,
+            # count_tokens is a blocking HTTP call; keep it off the event loop
+            counted = await asyncio.to_thread(
+                self.llm.messages.count_tokens,
+                model=model,
+                messages=messages,
+                tools=self.tools,
+            )
+            return counted.input_tokens
+        except Exception as e:
+            self.logger.warning(f"Failed to count tokens, using previous call as estimate: {str(e)}")
+            return query_usage.calls[-1]["input_tokens"] if query_usage.calls else 0
+
+    async def call_llm(self, messages: list, session_id: str = "default", query_usage: Optional[QueryUsage] = None) -> "Message":
+        """
+        Call the LLM with the given messages, enforcing budgets and recording usage.
+        A reply cut off at max_tokens is returned with `query_usage.truncated` set.
+        """
+        query_usage = query_usage if query_usage is not None else QueryUsage()
+
+        model = self.model
+        if self.fallback_model and self.usage.should_downshift(session_id):
+            model = self.fallback_model
+
+        # Only pay for a token count when there is a budget to check it against
+        remaining = self.usage.remaining_tokens(session_id, query_usage)
+        input_tokens = 0
+        if remaining is not None:
+            input_tokens = await self.estimate_input_tokens(model, messages, query_usage)
+            if model != self.fallback_model and self.fallback_model and self.usage.should_downshift(session_id, input_tokens):
+                # This call's input tips it over the downshift threshold: recount for the fallback
+                model = self.fallback_model
+                input_tokens = await self.estimate_input_tokens(model, messages, query_usage)
+        self.usage.check_llm_call(session_id, query_usage, input_tokens)
+
+        if model != self.model:
+            self.logger.info(f"Session '{session_id}' near its token budget, using {model}")
+
+        max_tokens = self.max_tokens
+        if remaining is not None:
+            max_tokens = min(max_tokens, remaining - input_tokens)
+
+        try:
+            response = self.llm.messages.create(
+                model=model,
+                max_tokens=max_tokens,
+                messages=messages,
                 tools=self.tools,
             )
         except Exception as e:
             self.logger.error(f"Failed to call LLM: {str(e)}")
             raise Exception(f"Failed to call LLM: {str(e)}")
 
+        call = self.usage.record_llm_call(session_id, query_usage, model, response.usage)
+        self.logger.info(
+            f"LLM usage ({model}): in={call.input_tokens} out={call.output_tokens} "
+            f"cache_write={call.cache_creation_input_tokens} cache_read={call.cache_read_input_tokens}"
+        )
+
+        if response.stop_reason == "max_tokens":
+            # Already billed, so hand the partial reply back; if the budget clamped
+            # max_tokens, nothing is left and the next call is rejected up front
+            self.logger.warning(f"Reply truncated at max_tokens={max_tokens}")
+            query_usage.truncated = True
+        return response
 
-    async def process_query(self, query: str):
+
+    async def process_query(self, query: str, session_id: str = "default", query_usage: Optional[QueryUsage] = None):
         """
-        Process a query using Claude and available tools, returning all messages at the end
+        Process a query using Claude and available tools, returning all messages at the end.
+        Each session keeps its own history; usage is accumulated into `query_usage` when given.
+        If the query fails, the session history is rolled back to where it started, so it
+        never keeps a tool_use without its tool_result.
         """
+        query_usage = query_usage if query_usage is not None else QueryUsage()
+        for idle in self.usage.evict_idle():
+            self.conversations.pop(idle, None)
+        self.usage.touch(session_id)
+
+        history = self.conversations.setdefault(session_id, [])
+        start = len(history)
         try:
+
             #  Log first 100 chars of query
             self.logger.info(
                 f"Processing new query: {query[:100]}..."
@@ -170,13 +333,27 @@ class MCPClient:
 
             # Add the initial user message
             user_message = {"role": "user", "content": query}
-            self.messages.append(user_message)
-            await self.log_conversation(self.messages)
+            history.append(user_message)
+            await self.log_conversation(history)
             messages = [user_message]
 
             while True:
                 self.logger.debug("Calling Claude API")
-                response = await self.call_llm()
+                response = await self.call_llm(history, session_id, query_usage)
+
+                # Reply cut off at max_tokens: keep its text and end the turn. Any
+                # tool_use in it may be incomplete and is dropped, so the history
+                # never holds a tool_use without a tool_result.
+                if response.stop_reason == "max_tokens":
+                    text = "".join(c.text for c in response.content if c.type == "text")
+                    assistant_message = {
+                        "role": "assistant",
+                        "content": text or "(reply cut off before any text)",
+                    }
+                    history.append(assistant_message)
+                    await self.log_conversation(history)
+                    messages.append(assistant_message)
+                    break
 
                 # If it's a simple text response
                 if response.content[0].type == "text" and len(response.content) == 1:
@@ -184,31 +361,35 @@ class MCPClient:
                         "role": "assistant",
                         "content": response.content[0].text,
                     }
-                    self.messages.append(assistant_message)
-                    await self.log_conversation(self.messages)
+                    history.append(assistant_message)
+                    await self.log_conversation(history)
                     messages.append(assistant_message)
                     break
 
                 # For more complex responses with tool calls
+                tool_uses = sum(1 for content in response.content if content.type == "tool_use")
+                self.usage.check_tool_calls(query_usage, tool_uses)
+
                 assistant_message = {
                     "role": "assistant",
                     "content": response.to_dict()["content"],
                 }
-                self.messages.append(assistant_message)
-                await self.log_conversation(self.messages)
+                history.append(assistant_message)
+                await self.log_conversation(history)
                 messages.append(assistant_message)
 
                 for content in response.content:
                     if content.type == "text":
                         # Text content within a complex response
                         text_message = {"role": "assistant", "content": content.text}
-                        await self.log_conversation(self.messages)
+                        await self.log_conversation(history)
                         messages.append(text_message)
                     elif content.type == "tool_use":
                         tool_name = content.name
                         tool_args = content.input
                         tool_use_id = content.id
 
+                        self.usage.record_tool_call(session_id, query_usage)
                         self.logger.info(
                             f"Executing tool: {tool_name} with args: {tool_args}"
                         )
@@ -250,8 +431,8 @@ class MCPClient:
                                         }
                                     ],
                                 }
-                            self.messages.append(tool_result_message)
-                            await self.log_conversation(self.messages)
+                            history.append(tool_result_message)
+                            await self.log_conversation(history)
                             messages.append(tool_result_message)
 
                         except Exception as e:
@@ -267,14 +448,15 @@ class MCPClient:
                                     }
                                 ],
                             }
-                            self.messages.append(tool_result_message)
-                            await self.log_conversation(self.messages)
+                            history.append(tool_result_message)
+                            await self.log_conversation(history)
                             messages.append(tool_result_message)
                             raise Exception(error_msg)
 
             return messages
 
         except Exception as e:
+            del history[start:]
             self.logger.error(f"Error processing query: {str(e)}")
             self.logger.debug(
                 f"Query processing error details: {traceback.format_exc()}"
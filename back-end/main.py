@@ -1,9 +1,13 @@
-from fastapi import FastAPI, HTTPException
+from profiling import IMPORTED_AT, startup_profile, profile, record
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Literal
+import asyncio
 from contextlib import asynccontextmanager
-from client import MCPClient
+from client import MCPClient, resolve_server_command
+from usage import UsageTracker, QueryUsage, BudgetExceeded
+from logs import logger
 from dotenv import load_dotenv
 from pydantic_settings import BaseSettings
 
@@ -19,53 +23,211 @@ class Settings(BaseSettings):
 
     server_remote_url: str = "http://127.0.0.1:8080/mcp"
 
+    # "stdio" spawns the local server, "http" connects to server_remote_url.
+    # Only the selected transport's library is imported.
+    transport: Literal["stdio", "http"] = "stdio"
+
+    # Interpreter with the server's dependencies. When unset, the server project's
+    # .venv is used if present, otherwise `uv run --frozen` (which creates it).
+    server_python: Optional[str] = None
+
+    # Seconds a request waits for the MCP connection to finish warming up
+    warmup_timeout: float = 30.0
+    # Failed connections are retried with exponential backoff, capped at this many seconds,
+    # up to warmup_max_attempts times. Configuration errors are not retried.
+    warmup_max_backoff: float = 30.0
+    warmup_max_attempts: int = 10
+
+    # LLM model selection
+    llm_model: str = "claude-sonnet-4-20250514"
+    llm_fallback_model: Optional[str] = "claude-3-5-haiku-20241022"
+    llm_max_tokens: int = 1000
+
+    # Budgets (unset = unlimited). Past downshift_ratio of a budget the fallback
+    # model is used; past the budget requests are rejected. Session ids come from
+    # the client, so only total_token_budget (whole process) is a hard cap.
+    total_token_budget: Optional[int] = None
+    session_token_budget: Optional[int] = None
+    query_token_budget: Optional[int] = None
+    max_tool_calls_per_query: Optional[int] = None
+    downshift_ratio: float = 0.8
+
+    # Sessions (usage and message history) idle this long are dropped
+    session_idle_seconds: float = 3600.0
+    # Sessions broken out by label in /metrics
+    metrics_top_sessions: int = 10
+
 settings = Settings()
 
 
+def build_client() -> MCPClient:
+    usage = UsageTracker(
+        total_token_budget=settings.total_token_budget,
+        session_token_budget=settings.session_token_budget,
+        query_token_budget=settings.query_token_budget,
+        max_tool_calls_per_query=settings.max_tool_calls_per_query,
+        downshift_ratio=settings.downshift_ratio,
+        session_idle_seconds=settings.session_idle_seconds,
+        metrics_top_sessions=settings.metrics_top_sessions,
+    )
+    return MCPClient(
+        usage=usage,
+        model=settings.llm_model,
+        fallback_model=settings.llm_fallback_model,
+        max_tokens=settings.llm_max_tokens,
+    )
+
+
+# Connection errors that retrying cannot fix (bad script path, missing executable)
+PERMANENT_ERRORS = (ValueError, FileNotFoundError, PermissionError)
+
+
+def _is_permanent(error: BaseException) -> bool:
+    # anyio task groups wrap failures in an ExceptionGroup
+    if isinstance(error, BaseExceptionGroup):
+        return all(_is_permanent(e) for e in error.exceptions)
+    return isinstance(error, PERMANENT_ERRORS)
+
+
+async def _warm_up(app: FastAPI, connect):
+    """
+    Connect to the MCP server, retrying with backoff, then hold the connection open
+    until shutdown. `connect` runs directly in this task so the transport contexts are
+    entered and exited in the same task; only the LLM SDK import runs alongside it.
+    Gives up (status "failed" in /health) on a configuration error or after
+    `warmup_max_attempts` attempts.
+    """
+    client = app.state.client
+    llm_task = asyncio.create_task(client.warm_llm())
+    try:
+        backoff = 1.0
+        with profile("warm_up"):
+            while True:
+                app.state.connect_attempts += 1
+                try:
+                    await connect(client)
+                    break
+                except Exception as e:
+                    app.state.startup_error = str(e)
+                    # Close whatever the failed attempt opened
+                    await client.cleanup()
+                    if _is_permanent(e) or app.state.connect_attempts >= settings.warmup_max_attempts:
+                        app.state.failed = True
+                        logger.error(
+                            f"Giving up on connecting to server after "
+                            f"{app.state.connect_attempts} attempt(s): {str(e)}"
+                        )
+                        break
+                    logger.error(
+                        f"Failed to connect to server (attempt {app.state.connect_attempts}), "
+                        f"retrying in {backoff:.0f}s: {str(e)}"
+                    )
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, settings.warmup_max_backoff)
+
+        if not app.state.failed:
+            try:
+                await llm_task
+            except Exception as e:
+                # Not fatal: the SDK is loaded again on first use and the error surfaces there
+                logger.error(f"Failed to load LLM SDK: {str(e)}")
+
+            app.state.startup_error = None
+            logger.info(f"Client ready, startup profile (ms): {startup_profile}")
+        app.state.ready.set()
+
+        await app.state.shutdown.wait()
+    finally:
+        llm_task.cancel()
+        # Shutdown
+        await client.cleanup()
+
+
 @asynccontextmanager
-async def lifespan(app: FastAPI):
+async def _background_client(app: FastAPI, connect):
     """
-    Manage client startup and shutdown
+    Serve immediately (e.g. /health) while the client warms up in the background
     """
+    if "imports" not in startup_profile:
+        record("imports", IMPORTED_AT)
 
-    #Startup
-    client = MCPClient()
+    app.state.client = build_client()
+    app.state.ready = asyncio.Event()
+    app.state.shutdown = asyncio.Event()
+    app.state.startup_error = None
+    app.state.connect_attempts = 0
+    app.state.failed = False
 
+    task = asyncio.create_task(_warm_up(app, connect))
     try:
+        yield
+    finally:
+        app.state.shutdown.set()
+        if not app.state.ready.is_set():
+            task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Manage client startup and shutdown
+    """
+    with profile("resolve_server_command"):
+        server_command = resolve_server_command(
+            settings.server_script_path,
+            settings.server_project_dir,
+            settings.server_python,
+        )
+
+    async def connect(client: MCPClient):
         connected = await client.connect_to_server(
             settings.server_script_path,
             server_cwd=settings.server_project_dir,
+            server_command=server_command,
         )
         if not connected:
             raise Exception("Failed to connect to server")
-        app.state.client = client
+
+    async with _background_client(app, connect):
         yield
-    except Exception as e:
-        raise Exception(f"Failed to connect to server: {str(e)}")
-    finally:
-        # Shutdown
-        await client.cleanup()
 
 @asynccontextmanager
 async def lifespan_remote(app: FastAPI):
     """
     Manage client startup and shutdown (REMOTE HTTP)
     """
-    #Startup
-    client = MCPClient()
-    try:
+    async def connect(client: MCPClient):
         ok = await client.connect_to_remote_server(settings.server_remote_url)
         if not ok:
             raise Exception("Failed to connect to remote server")
-        app.state.client = client
+
+    async with _background_client(app, connect):
         yield
-    except Exception as e:
-        raise Exception(f"Failed to connect to remote server: {str(e)}")
-    finally:
-        # Shutdown
-        await client.cleanup()
 
-app = FastAPI(title="MCP Chatbot Redes", lifespan=lifespan)
+
+async def get_client() -> MCPClient:
+    """
+    Return the client once it is connected, or fail with 503
+    """
+    try:
+        await asyncio.wait_for(app.state.ready.wait(), timeout=settings.warmup_timeout)
+    except asyncio.TimeoutError:
+        detail = "MCP connection is still warming up"
+        if app.state.startup_error:
+            detail += f" (last error: {app.state.startup_error})"
+        raise HTTPException(status_code=503, detail=detail)
+    if app.state.failed:
+        raise HTTPException(status_code=503, detail=f"Failed to connect to server: {app.state.startup_error}")
+    return app.state.client
+
+app = FastAPI(
+    title="MCP Chatbot Redes",
+    lifespan=lifespan_remote if settings.transport == "http" else lifespan,
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -77,6 +239,7 @@ app.add_middleware(
 
 class QueryRequest(BaseModel):
     query: str
+    session_id: str = "default"
 
 class Message(BaseModel):
     role: str
@@ -91,41 +254,93 @@ async def process_query(request: QueryRequest):
     """
     Process a query and return the response
     """
+    client = await get_client()
+    query_usage = QueryUsage()
     try:
         messages = []
-        messages = await app.state.client.process_query(request.query)
-        
-        return {"messages": messages}
+        messages = await client.process_query(
+            request.query, session_id=request.session_id, query_usage=query_usage
+        )
+
+        return {
+            "messages": messages,
+            "usage": {
+                "query": query_usage.to_dict(),
+                "session": client.usage.session(request.session_id).to_dict(),
+            },
+        }
+    except BudgetExceeded as e:
+        raise HTTPException(status_code=429, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/health")
+async def health():
+    """
+    Liveness and warm-up status, available before the MCP connection is ready
+    """
+    if app.state.failed:
+        status = "failed"
+    elif app.state.ready.is_set():
+        status = "ready"
+    elif app.state.startup_error:
+        status = "retrying"
+    else:
+        status = "starting"
+    return {
+        "status": status,
+        "error": app.state.startup_error,
+        "connect_attempts": app.state.connect_attempts,
+        "startup_ms": startup_profile,
+    }
+
+@app.get("/usage")
+async def get_usage():
+    """
+    Token and tool call usage for every session, plus configured budgets.
+    Sessions are listed by an opaque key, never by their id.
+    """
+    return app.state.client.usage.to_dict()
+
+@app.get("/usage/{session_id}")
+async def get_session_usage(session_id: str):
+    """
+    Token and tool call usage for one session
+    """
+    return app.state.client.usage.session(session_id).to_dict()
+
+@app.get("/metrics")
+async def metrics():
+    """
+    Usage counters in Prometheus text format
+    """
+    return Response(
+        content=app.state.client.usage.render_metrics(),
+        media_type="text/plain; version=0.0.4",
+    )
+
 @app.get("/tools")
-async def get_available_tools():
+async def get_available_tools(request: Request, response: Response):
     """
-    Get list of available tools from the server
+    Get list of available tools, as cached from the server at connect time.
+    Sends an ETag so clients can revalidate with If-None-Match and get a 304.
     """
-    try:
-        tools = await app.state.client.get_mcp_tools()
-        return {
-            "tools": [
-                {
-                    "name": tool.name,
-                    "description": tool.description,
-                    "input_schema": tool.inputSchema,
-                }
-                for tool in tools
-            ]
-        }
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    client = await get_client()
+    etag = client.tools_etag
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    response.headers["ETag"] = etag
+    return {"tools": client.tools}
 
 @app.post("/tool")
 async def call_tool(tool_call: ToolCall):
     """
     Call a specific tool from the server
     """
+    client = await get_client()
     try:
-        result = await app.state.client.call_tool(tool_call.name, tool_call.args)
+        result = await client.call_tool(tool_call.name, tool_call.args)
         return {"result": result}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
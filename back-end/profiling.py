@@ -0,0 +1,33 @@
+from contextlib import contextmanager
+from typing import Dict
+import time
+from logs import logger
+
+# Startup phase -> duration in milliseconds, exposed by GET /health
+startup_profile: Dict[str, float] = {}
+
+# Taken when this module is first imported. main.py imports it first, so the
+# "imports" phase (recorded at lifespan start) covers the app's imports and
+# setup up to the point the server starts the lifespan
+IMPORTED_AT = time.perf_counter()
+
+
+def record(phase: str, started: float):
+    """
+    Store the time elapsed since `started` (a time.perf_counter() value) for a phase
+    """
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    startup_profile[phase] = round(elapsed_ms, 1)
+    logger.info(f"Startup phase '{phase}' took {elapsed_ms:.1f} ms")
+
+
+@contextmanager
+def profile(phase: str):
+    """
+    Time a block as a named startup phase
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(phase, started)
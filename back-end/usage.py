@@ -0,0 +1,247 @@
+from dataclasses import dataclass, field, asdict
+from typing import Dict, List, Optional
+import hashlib
+import threading
+import time
+
+
+class BudgetExceeded(Exception):
+    """
+    Raised before an LLM call or tool call that would go past a configured budget
+    """
+
+
+@dataclass
+class Usage:
+    """
+    Token and call counters, used per call, per query and per session
+    """
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cache_creation_input_tokens: int = 0
+    cache_read_input_tokens: int = 0
+    llm_calls: int = 0
+    tool_calls: int = 0
+
+    @property
+    def total_tokens(self) -> int:
+        return (
+            self.input_tokens
+            + self.output_tokens
+            + self.cache_creation_input_tokens
+            + self.cache_read_input_tokens
+        )
+
+    @classmethod
+    def from_response(cls, usage) -> "Usage":
+        """
+        Build from an Anthropic `response.usage` object (cache fields may be None)
+        """
+        return cls(
+            input_tokens=getattr(usage, "input_tokens", 0) or 0,
+            output_tokens=getattr(usage, "output_tokens", 0) or 0,
+            cache_creation_input_tokens=getattr(usage, "cache_creation_input_tokens", 0) or 0,
+            cache_read_input_tokens=getattr(usage, "cache_read_input_tokens", 0) or 0,
+            llm_calls=1,
+        )
+
+    def add(self, other: "Usage"):
+        self.input_tokens += other.input_tokens
+        self.output_tokens += other.output_tokens
+        self.cache_creation_input_tokens += other.cache_creation_input_tokens
+        self.cache_read_input_tokens += other.cache_read_input_tokens
+        self.llm_calls += other.llm_calls
+        self.tool_calls += other.tool_calls
+
+    def to_dict(self) -> dict:
+        data = asdict(self)
+        data["total_tokens"] = self.total_tokens
+        return data
+
+
+@dataclass
+class QueryUsage(Usage):
+    """
+    Usage of a single query, keeping the per-call breakdown
+    """
+    calls: List[dict] = field(default_factory=list)
+    # Set when a reply stopped at max_tokens
+    truncated: bool = False
+
+    def to_dict(self) -> dict:
+        data = super().to_dict()
+        data["calls"] = list(self.calls)
+        return data
+
+
+def session_key(session_id: str) -> str:
+    """
+    Opaque stand-in for a session id in public output. The id itself resumes the
+    session's conversation, so it must not be listed by /usage or /metrics.
+    """
+    return hashlib.sha256(session_id.encode()).hexdigest()[:12]
+
+
+class UsageTracker:
+    """
+    Accumulates usage per session and enforces the configured budgets.
+    A budget of None means unlimited. Sessions idle for longer than
+    `session_idle_seconds` are evicted; `totals` keeps counting across them.
+    Session ids are chosen by the client, so only `total_token_budget` is a hard
+    cap on spend; the session budget is advisory.
+    """
+    def __init__(
+        self,
+        total_token_budget: Optional[int] = None,
+        session_token_budget: Optional[int] = None,
+        query_token_budget: Optional[int] = None,
+        max_tool_calls_per_query: Optional[int] = None,
+        downshift_ratio: float = 0.8,
+        session_idle_seconds: float = 3600.0,
+        metrics_top_sessions: int = 10,
+    ):
+        self.total_token_budget = total_token_budget
+        self.session_token_budget = session_token_budget
+        self.query_token_budget = query_token_budget
+        self.max_tool_calls_per_query = max_tool_calls_per_query
+        self.downshift_ratio = downshift_ratio
+        self.session_idle_seconds = session_idle_seconds
+        self.metrics_top_sessions = metrics_top_sessions
+        self.sessions: Dict[str, Usage] = {}
+        self.last_seen: Dict[str, float] = {}
+        self.totals = Usage()
+        self.lock = threading.Lock()
+
+    def session(self, session_id: str) -> Usage:
+        with self.lock:
+            return self.sessions.get(session_id) or Usage()
+
+    def touch(self, session_id: str):
+        with self.lock:
+            self.last_seen[session_id] = time.monotonic()
+
+    def evict_idle(self) -> List[str]:
+        """
+        Drop sessions idle past `session_idle_seconds`, returning their ids
+        """
+        cutoff = time.monotonic() - self.session_idle_seconds
+        with self.lock:
+            idle = [sid for sid, seen in self.last_seen.items() if seen < cutoff]
+            for sid in idle:
+                self.last_seen.pop(sid, None)
+                self.sessions.pop(sid, None)
+        return idle
+
+    def remaining_tokens(self, session_id: str, query_usage: Usage) -> Optional[int]:
+        """
+        Tokens left before the tightest of the process, session and query budgets, or None if unlimited
+        """
+        limits = []
+        if self.total_token_budget is not None:
+            with self.lock:
+                limits.append(self.total_token_budget - self.totals.total_tokens)
+        if self.session_token_budget is not None:
+            limits.append(self.session_token_budget - self.session(session_id).total_tokens)
+        if self.query_token_budget is not None:
+            limits.append(self.query_token_budget - query_usage.total_tokens)
+        return min(limits) if limits else None
+
+    def check_llm_call(self, session_id: str, query_usage: Usage, input_tokens: int = 0):
+        """
+        Reject a call whose estimated `input_tokens` would not leave room for any output
+        """
+        remaining = self.remaining_tokens(session_id, query_usage)
+        if remaining is not None and remaining - input_tokens <= 0:
+            raise BudgetExceeded(
+                f"Token budget exhausted ({input_tokens} input tokens needed, {max(remaining, 0)} left)"
+            )
+
+    def check_tool_calls(self, query_usage: Usage, count: int = 1):
+        """
+        Reject `count` more tool calls if they would go past the per-query limit
+        """
+        limit = self.max_tool_calls_per_query
+        if limit is not None and query_usage.tool_calls + count > limit:
+            raise BudgetExceeded(f"Tool call limit reached ({limit} per query)")
+
+    def should_downshift(self, session_id: str, input_tokens: int = 0) -> bool:
+        """
+        True once the session or the whole process has spent, or with
+        `input_tokens` would spend, `downshift_ratio` of its budget
+        """
+        if self.session_token_budget is not None:
+            spent = self.session(session_id).total_tokens + input_tokens
+            if spent >= self.session_token_budget * self.downshift_ratio:
+                return True
+        if self.total_token_budget is not None:
+            with self.lock:
+                spent = self.totals.total_tokens + input_tokens
+            if spent >= self.total_token_budget * self.downshift_ratio:
+                return True
+        return False
+
+    def record_llm_call(self, session_id: str, query_usage: QueryUsage, model: str, response_usage) -> Usage:
+        call = Usage.from_response(response_usage)
+        query_usage.add(call)
+        query_usage.calls.append({"model": model, **call.to_dict()})
+        with self.lock:
+            self.sessions.setdefault(session_id, Usage()).add(call)
+            self.last_seen[session_id] = time.monotonic()
+            self.totals.add(call)
+        return call
+
+    def record_tool_call(self, session_id: str, query_usage: Usage):
+        call = Usage(tool_calls=1)
+        query_usage.add(call)
+        with self.lock:
+            self.sessions.setdefault(session_id, Usage()).add(call)
+            self.last_seen[session_id] = time.monotonic()
+            self.totals.add(call)
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                "budgets": {
+                    "total_token_budget": self.total_token_budget,
+                    "session_token_budget": self.session_token_budget,
+                    "query_token_budget": self.query_token_budget,
+                    "max_tool_calls_per_query": self.max_tool_calls_per_query,
+                    "downshift_ratio": self.downshift_ratio,
+                    "session_idle_seconds": self.session_idle_seconds,
+                },
+                "totals": self.totals.to_dict(),
+                # Keyed by session_key(): raw ids would let any caller resume other sessions
+                "sessions": {session_key(sid): usage.to_dict() for sid, usage in self.sessions.items()},
+            }
+
+    def render_metrics(self) -> str:
+        """
+        Prometheus text exposition: process-wide counters, plus a gauge for the
+        `metrics_top_sessions` biggest sessions to keep label cardinality bounded
+        """
+        fields = [
+            ("input_tokens", "Input tokens sent to the LLM"),
+            ("output_tokens", "Output tokens generated by the LLM"),
+            ("cache_creation_input_tokens", "Input tokens written to the prompt cache"),
+            ("cache_read_input_tokens", "Input tokens read from the prompt cache"),
+            ("llm_calls", "LLM API calls"),
+            ("tool_calls", "MCP tool calls"),
+        ]
+        lines = []
+        with self.lock:
+            for name, help_text in fields:
+                metric = f"mcp_client_{name}_total"
+                lines.append(f"# HELP {metric} {help_text}")
+                lines.append(f"# TYPE {metric} counter")
+                lines.append(f"{metric} {getattr(self.totals, name)}")
+
+            lines.append("# HELP mcp_client_active_sessions Sessions with usage that have not been evicted")
+            lines.append("# TYPE mcp_client_active_sessions gauge")
+            lines.append(f"mcp_client_active_sessions {len(self.sessions)}")
+
+            top = sorted(self.sessions.items(), key=lambda kv: kv[1].total_tokens, reverse=True)
+            lines.append("# HELP mcp_client_session_tokens Total tokens of the largest active sessions")
+            lines.append("# TYPE mcp_client_session_tokens gauge")
+            for sid, usage in top[:self.metrics_top_sessions]:
+                lines.append(f'mcp_client_session_tokens{{session="{session_key(sid)}"}} {usage.total_tokens}')
+        return "\n".join(lines) + "\n"
@@ -1,16 +1,181 @@
 import streamlit as st
 import httpx
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 import json
+import threading
+import time
+import uuid
+from logs import logger
+
+
+# Seconds the tool list is served from memory before revalidating with the back-end
+TOOLS_TTL_SECONDS = 60.0
+# Seconds a failed /tools fetch is remembered before trying again
+TOOLS_RETRY_SECONDS = 5.0
+# /tools is answered from the back-end's cache, so a slow reply means it is not ready yet
+TOOLS_TIMEOUT_SECONDS = 3.0
+
+# Number of messages drawn on each rerun; older history is paged in windows of this size
+HISTORY_WINDOW = 20
+
+# Tool results longer than this are shown as a preview until the user asks for the full payload
+RESULT_PREVIEW_CHARS = 2000
+# Full payloads are paged in chunks of this size
+RESULT_PAGE_CHARS = 20000
+
+
+@st.cache_resource
+def get_http_client(api_url: str) -> httpx.Client:
+    """
+    Process-wide keep-alive client, shared by every Streamlit session.
+    httpx.Client is thread-safe and, unlike AsyncClient, is not bound to the
+    event loop that asyncio.run() creates (and closes) on every rerun.
+    """
+    logger.info(f"Creating pooled HTTP client for {api_url}")
+    return httpx.Client(
+        base_url=api_url,
+        timeout=30.0,
+        verify=False,
+        headers={"Content-Type": "application/json"},
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60.0),
+    )
+
+
+class ToolsCache:
+    """
+    TTL + ETag cache of the back-end tool list.
+    Within the TTL no request is made; after it, a conditional GET revalidates.
+    Only one caller refreshes at a time, outside the lock; the others keep getting
+    the stale copy. Failures are remembered for TOOLS_RETRY_SECONDS.
+    """
+    def __init__(self, ttl: float = TOOLS_TTL_SECONDS):
+        self.ttl = ttl
+        self.tools: Optional[list] = None
+        self.etag: Optional[str] = None
+        self.fetched_at = 0.0
+        self.error: Optional[Exception] = None
+        self.failed_at = 0.0
+        self.refreshing = False
+        self.lock = threading.Lock()
+
+    def get(self, client: httpx.Client) -> list:
+        with self.lock:
+            now = time.monotonic()
+            if self.tools is not None and now - self.fetched_at < self.ttl:
+                return self.tools
+            if self.refreshing or (self.error and now - self.failed_at < TOOLS_RETRY_SECONDS):
+                if self.tools is not None:
+                    return self.tools
+                raise self.error or RuntimeError("Tool list is loading")
+            self.refreshing = True
+            etag = self.etag
+
+        try:
+            headers = {"If-None-Match": etag} if etag else {}
+            resp = client.get("/tools", headers=headers, timeout=TOOLS_TIMEOUT_SECONDS)
+            if resp.status_code == 304 and self.tools is not None:
+                logger.debug("Tool list not modified, keeping cached copy")
+                tools, etag = self.tools, self.etag
+            else:
+                resp.raise_for_status()
+                tools, etag = resp.json().get("tools", []), resp.headers.get("etag")
+        except Exception as e:
+            with self.lock:
+                self.error = e
+                self.failed_at = time.monotonic()
+                self.refreshing = False
+            raise
+
+        with self.lock:
+            self.tools, self.etag = tools, etag
+            self.fetched_at = time.monotonic()
+            self.error = None
+            self.refreshing = False
+            return self.tools
+
+    def invalidate(self):
+        with self.lock:
+            self.fetched_at = 0.0
+            self.error = None
+
+
+@st.cache_resource
+def get_tools_cache(api_url: str) -> ToolsCache:
+    return ToolsCache()
 
 
 class Chatbot:
     def __init__(self, api_url: str):
         self.api_url = api_url
-        self.current_tool_call = {"name": None, "args": None}
         self.messages = st.session_state["messages"]
+        self.client = get_http_client(api_url)
+        self.tools_cache = get_tools_cache(api_url)
+
+    def append_messages(self, new_messages: list):
+        """
+        Append a turn to the history in place, index its tool calls by id and
+        serialize its tool results once, so reruns never replay or re-serialize
+        earlier messages.
+        """
+        tool_names = st.session_state["tool_names"]
+        result_texts = st.session_state["result_texts"]
+        for message in new_messages:
+            index = len(self.messages)
+            if message["role"] == "assistant" and isinstance(message["content"], list):
+                for content in message["content"]:
+                    if content.get("type") == "tool_use":
+                        tool_names[content["id"]] = content["name"]
+            if message["role"] == "user" and isinstance(message["content"], list):
+                for j, content in enumerate(message["content"]):
+                    if content.get("type") == "tool_result":
+                        for i, item in enumerate(content.get("content", []), start=1):
+                            result_texts[self.result_key(index, j, i)] = self.serialize_result_item(item)
+            self.messages.append(message)
+
+    @staticmethod
+    def result_key(index: int, j: int, i: int) -> str:
+        return f"result-{index}-{j}-{i}"
+
+    @staticmethod
+    def serialize_result_item(item: Dict[str, Any]) -> str:
+        itype = item.get("type")
+        if itype == "json" and "json" in item:
+            return json.dumps(item["json"], indent=2, default=str)
+        if itype == "text" and "text" in item:
+            return item["text"]
+        return str(item)
+
+    def display_result_item(self, item: Dict[str, Any], key: str):
+        """
+        Render one tool result item from its text serialized at append time.
+        Large payloads show a preview and are paged once the full result is requested.
+        """
+        itype = item.get("type")
+        result_texts = st.session_state["result_texts"]
+        if key not in result_texts:
+            result_texts[key] = self.serialize_result_item(item)
+        text = result_texts[key]
+
+        if len(text) <= RESULT_PREVIEW_CHARS:
+            if itype == "json" and "json" in item:
+                st.json(item["json"])
+            else:
+                st.code(text)
+            return
+
+        st.caption(f"{len(text):,} characters")
+        if not st.toggle("Load full result", key=f"{key}-full"):
+            st.code(text[:RESULT_PREVIEW_CHARS] + "\n…")
+            return
+
+        pages = -(-len(text) // RESULT_PAGE_CHARS)
+        page = 1
+        if pages > 1:
+            page = st.number_input("Page", min_value=1, max_value=pages, value=1, key=f"{key}-page")
+        offset = (page - 1) * RESULT_PAGE_CHARS
+        st.code(text[offset:offset + RESULT_PAGE_CHARS])
 
-    def display_message(self, message: Dict[str, Any]):
+    def display_message(self, message: Dict[str, Any], index: int):
         """
         Render a single message with nice chat bubbles and tool cards.
         """
@@ -20,13 +185,16 @@ class Chatbot:
 
         # Tool result (assistant reply to a tool call)
         if message["role"] == "user" and isinstance(message["content"], list):
-            for content in message["content"]:
+            for j, content in enumerate(message["content"]):
                 if content.get("type") == "tool_result":
+                    tool_name = st.session_state["tool_names"].get(content.get("tool_use_id"), "unknown")
                     with st.chat_message("assistant", avatar="🤖"):
                         st.markdown(
-                            f"**Tool executed:** `{self.current_tool_call['name']}`", help="Tool call result"
+                            f"**Tool executed:** `{tool_name}`", help="Tool call result"
                         )
-                        with st.expander("View result JSON", expanded=False):
+                        # A toggle rather than st.expander: an expander's body runs
+                        # (and is sent to the browser) even while collapsed
+                        if st.toggle("View result JSON", key=f"result-{index}-{j}-open"):
                             items = content.get("content", [])
                             if not items:
                                 st.caption("No content returned by tool.")
@@ -35,41 +203,51 @@ class Chatbot:
                                     itype = item.get("type")
                                     if itype == "json" and "json" in item:
                                         st.markdown(f"**Item {i} (JSON):**")
-                                        st.json(item["json"])
                                     elif itype == "text" and "text" in item:
                                         st.markdown(f"**Item {i} (text):**")
-                                        # Show plain text
-                                        st.code(item["text"])
                                     else:
                                         st.markdown(f"**Item {i} (raw):**")
-                                        st.code(str(item))
+                                    self.display_result_item(item, key=self.result_key(index, j, i))
 
         # Assistant text
         if message["role"] == "assistant" and isinstance(message["content"], str):
             st.chat_message("assistant", avatar="🤖").markdown(message["content"])
 
-        # Assistant tool use (store current call so we can label the result)
-        if message["role"] == "assistant" and isinstance(message["content"], list):
-            for content in message["content"]:
-                if content.get("type") == "tool_use":
-                    self.current_tool_call = {
-                        "name": content["name"],
-                        "args": content["input"],
-                    }
+    def show_turn(self, data: Dict[str, Any]) -> bool:
+        """
+        Append a /query response and draw it.
+        Returns True when the UI should instead rerun to jump back to the newest messages.
+        """
+        messages = data.get("messages", [])
+        usage = data.get("usage")
+        st.session_state["usage"] = usage
+        if usage and usage["query"].get("truncated"):
+            st.warning("The reply was cut off at the maximum response length.", icon="✂️")
+
+        first = len(self.messages)
+        self.append_messages(messages)
+        if st.session_state["history_offset"]:
+            # Paged back in history: jump to the newest window instead
+            st.session_state["history_offset"] = 0
+            return True
+
+        # Only the new turn needs drawing; history is already on screen
+        for index in range(first, len(self.messages)):
+            self.display_message(self.messages[index], index)
+        return False
 
     async def get_tools(self):
         """
-        Get the tools from the server
+        Get the tools from the server (cached, see ToolsCache)
         """
-        async with httpx.AsyncClient(timeout=30.0, verify=False) as client:
-            resp = await client.get(f"{self.api_url}/tools", headers={"Content-Type": "application/json"})
-            resp.raise_for_status()
-            return resp.json()
+        return {"tools": self.tools_cache.get(self.client)}
 
     async def render(self):
         """
         Render entire UI (sidebar + chat area)
         """
+        started = time.perf_counter()
+
         # Sidebar: status + tools
         with st.sidebar:
             st.subheader("Settings")
@@ -90,32 +268,72 @@ class Chatbot:
             else:
                 st.caption("No tools available")
 
+            if st.button("🔄 Refresh tools", use_container_width=True):
+                self.tools_cache.invalidate()
+                st.rerun()
+
+            usage = st.session_state["usage"]
+            if usage:
+                st.subheader("Usage")
+                session = usage["session"]
+                st.caption(
+                    f"Session: {session['total_tokens']:,} tokens "
+                    f"({session['input_tokens']:,} in / {session['output_tokens']:,} out, "
+                    f"{session['cache_read_input_tokens']:,} cache read), "
+                    f"{session['tool_calls']} tool calls"
+                )
+                st.caption(f"Last query: {usage['query']['total_tokens']:,} tokens")
+
             st.markdown("---")
             if st.button("🧹 Clear chat", use_container_width=True):
                 st.session_state["messages"] = []
-                self.messages = []
+                st.session_state["tool_names"] = {}
+                st.session_state["result_texts"] = {}
+                st.session_state["history_offset"] = 0
+                # The back-end keeps history per session, so start a new one
+                st.session_state["session_id"] = uuid.uuid4().hex
+                st.session_state["usage"] = None
+                self.messages = st.session_state["messages"]
                 st.rerun()
 
-        # Existing messages
-        for msg in self.messages:
-            self.display_message(msg)
+        # Existing messages: one fixed-size window, ending `history_offset` messages before the newest
+        offset = st.session_state["history_offset"]
+        end = len(self.messages) - offset
+        start = max(0, end - HISTORY_WINDOW)
+        if start > 0:
+            if st.button(f"⬆️ Show older messages ({start} earlier)", use_container_width=True):
+                st.session_state["history_offset"] = offset + HISTORY_WINDOW
+                st.rerun()
+        for index in range(start, end):
+            self.display_message(self.messages[index], index)
+        if offset:
+            if st.button(f"⬇️ Back to newest messages ({offset} later)", use_container_width=True):
+                st.session_state["history_offset"] = 0
+                st.rerun()
 
         # New query
         query = st.chat_input("Type your question or ask me to run a tool…")
         if query:
-            async with httpx.AsyncClient(timeout=60.0, verify=False) as client:
-                try:
-                    resp = await client.post(
-                        f"{self.api_url}/query",
-                        json={"query": query},
-                        headers={"Content-Type": "application/json"},
-                    )
+            jump_to_newest = False
+            try:
+                resp = self.client.post(
+                    "/query",
+                    json={"query": query, "session_id": st.session_state["session_id"]},
+                    timeout=60.0,
+                )
+                if resp.status_code == 429:
+                    # Over budget: the back-end explains which limit in `detail`
+                    st.warning(f"Budget limit reached: {resp.json().get('detail', resp.text)}", icon="💸")
+                else:
                     resp.raise_for_status()
-                    data = resp.json()
-                    messages = data.get("messages", [])
-                    st.session_state["messages"] = messages
-                    # Re-render freshly
-                    for msg in st.session_state["messages"]:
-                        self.display_message(msg)
-                except Exception as e:
-                    st.error(f"Frontend: Error processing query: {str(e)}")
+                    jump_to_newest = self.show_turn(resp.json())
+            except Exception as e:
+                st.error(f"Frontend: Error processing query: {str(e)}")
+            if jump_to_newest:
+                st.rerun()
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        st.session_state["render_ms"] = elapsed_ms
+        logger.debug(f"Render took {elapsed_ms:.1f} ms ({len(self.messages)} messages)")
+        with st.sidebar:
+            st.caption(f"Last render: {elapsed_ms:.1f} ms")
@@ -1,4 +1,5 @@
 import asyncio
+import uuid
 import streamlit as st
 from logs import logger
 from chatbot import Chatbot
@@ -88,6 +89,16 @@ async def main():
         st.session_state["tools"] = []
     if "messages" not in st.session_state:
         st.session_state["messages"] = []
+    if "tool_names" not in st.session_state:
+        st.session_state["tool_names"] = {}
+    if "session_id" not in st.session_state:
+        st.session_state["session_id"] = uuid.uuid4().hex
+    if "usage" not in st.session_state:
+        st.session_state["usage"] = None
+    if "result_texts" not in st.session_state:
+        st.session_state["result_texts"] = {}
+    if "history_offset" not in st.session_state:
+        st.session_state["history_offset"] = 0
 
     st.set_page_config(
         page_title="MCP Chatbot Redes",